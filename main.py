@@ -1,40 +1,44 @@
 
+import os
 import logging
 import asyncio
+import time
 from telegram.ext import CommandHandler
 from telegram_bot import (
     build_application,
     broadcast_message,
-    subscribe_command,
-    unsubscribe_command,
-    list_command,
-    start_command,
-    load_subscriptions,
     chat_subscriptions,
+    wakeup_event,
 )
 
 from polkachu_upgrades import (
-    fetch_upgrades,
-    parse_upgrades,
-    filter_upgrades,
+    fetch_upgrades_async,
     check_for_new_or_changed_upgrades,
+    prune_last_upgrades,
     hours_until_upgrade,
-    last_upgrades
+    last_upgrades,
+    ALERT_THRESHOLDS,
 )
 
 # Configure logging
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
 POLL_INTERVAL_SECONDS = 900  # 15 minutes, Polkachu if this is to much tell me and I'll make it less
 
+# Long-poll timeout for Telegram getUpdates, in seconds
+GET_UPDATES_TIMEOUT = 30
+
+# Handle to the background scheduler task
+scheduler_task = None
+
 async def test_alert(update, context):
     """Test command to verify alerting functionality"""
     chat_id = update.effective_chat.id
-    logger.info(f"Test alert requested by chat_id: {chat_id}")
+    logger.info("Test alert requested by chat_id: %s", chat_id)
 
     test_msg = (
         "🔔 Test Alert!\n"
@@ -59,26 +63,28 @@ async def list_upgrades(update, context):
     from telegram_bot import get_chat_subscriptions  # Add this import
 
     chat_id = update.effective_chat.id
-    logger.info("================ LIST UPGRADES DEBUG ================")
-    logger.info(f"List upgrades requested by chat_id: {chat_id}")
+    logger.debug("================ LIST UPGRADES DEBUG ================")
+    logger.info("List upgrades requested by chat_id: %s", chat_id)
 
     # Get subscriptions using the new function
     subs = get_chat_subscriptions(chat_id)
-    logger.info(f"Subscriptions found for chat_id {chat_id}: {subs}")
+    logger.debug("Subscriptions found for chat_id %s: %s", chat_id, subs)
 
     if not subs:
-        logger.warning(f"No subscriptions found for chat_id {chat_id}")
+        logger.warning("No subscriptions found for chat_id %s", chat_id)
         await update.message.reply_text("You haven't subscribed to any networks yet. Use /subscribe to add networks.")
         return
 
     # Fetch current upgrades
-    logger.info("Fetching upgrades from Polkachu")
-    raw_data = fetch_upgrades()
-    parsed = parse_upgrades(raw_data)
+    logger.debug("Fetching upgrades from Polkachu")
+    parsed = await fetch_upgrades_async()
+    if parsed is None:
+        await update.message.reply_text("Couldn't fetch upgrades from Polkachu right now. Please try again later.")
+        return
 
     # Filter for subscribed networks
-    subscribed_upgrades = [upg for upg in parsed if upg["network"].lower() in subs]
-    logger.info(f"Found {len(subscribed_upgrades)} upgrades for subscribed networks")
+    subscribed_upgrades = [upg for upg in parsed if upg.network.lower() in subs]
+    logger.debug("Found %d upgrades for subscribed networks", len(subscribed_upgrades))
 
     if not subscribed_upgrades:
         await update.message.reply_text("No upcoming upgrades found for your subscribed networks.")
@@ -87,10 +93,10 @@ async def list_upgrades(update, context):
     # Build response message...
     msg = "📊 Upcoming Upgrades\n\n"
     for upg in subscribed_upgrades:
-        network = upg["network"]
-        version = upg["node_version"]
-        est_time = upg["estimated_upgrade_time"]
-        h_left = hours_until_upgrade(est_time)
+        network = upg.network
+        version = upg.node_version
+        est_time = upg.estimated_upgrade_time
+        h_left = hours_until_upgrade(upg)
 
         if h_left > 24:
             days_left = round(h_left / 24, 1)
@@ -112,109 +118,127 @@ async def list_upgrades(update, context):
 
     await update.message.reply_text(msg)
 
-async def check_upgrades(context):
-    """Background task to check for upgrades"""
-    application = context.application
-    try:
-        logger.info("Checking for upgrades...")
-        raw_data = fetch_upgrades()
-        parsed = parse_upgrades(raw_data)
-        relevant = filter_upgrades(parsed)
-
-        # Log current state
-        logger.info(f"Found {len(relevant)} relevant upgrades")
-        for upg in relevant:
-            logger.info(f"Processing upgrade: {upg['network']} -> {upg['node_version']} at {upg['estimated_upgrade_time']}")
-
-            network = upg["network"]
-            version = upg["node_version"]
-            est_time = upg["estimated_upgrade_time"]
-
-            # Get or initialize alert flags
-            if network not in last_upgrades:
-                last_upgrades[network] = upg.copy()
-                last_upgrades[network]["alerts_sent"] = {
-                    "24_hours": False,
-                    "2_hours": False,
-                    "upgrade_time": False
-                }
-
-            alerts_sent = last_upgrades[network].get("alerts_sent", {})
-            h_left = hours_until_upgrade(est_time)
-            logger.info(f"{network}: {h_left:.1f} hours until upgrade. Alerts sent: {alerts_sent}")
-
-            try:
-                # 24 hour alert
-                if 23 <= h_left <= 24 and not alerts_sent.get("24_hours", False):
-                    logger.info(f"Sending 24-hour alert for {network}")
-                    alerts_sent["24_hours"] = True
-                    msg = (
-                        f"⚠️ [24 HOUR ALERT] Chain upgrade approaching!\n"
-                        f"Network: {network}\n"
-                        f"Version: {version}\n"
-                        f"Time: {est_time}\n"
-                        f"Status: Upgrade in approximately 24 hours"
-                    )
-                    await broadcast_message(application, msg, network=network)
-
-                # 2 hour alert
-                if 1.9 <= h_left <= 2.1 and not alerts_sent.get("2_hours", False):
-                    logger.info(f"Sending 2-hour alert for {network}")
-                    alerts_sent["2_hours"] = True
-                    msg = (
-                        f"🚨 [2 HOUR ALERT] Chain upgrade imminent!\n"
-                        f"Network: {network}\n"
-                        f"Version: {version}\n"
-                        f"Time: {est_time}\n"
-                        f"Status: Upgrade in approximately 2 hours"
-                    )
-                    await broadcast_message(application, msg, network=network)
-
-                # Upgrade time alert
-                if -0.1 <= h_left <= 0.1 and not alerts_sent.get("upgrade_time", False):
-                    logger.info(f"Sending upgrade-time alert for {network}")
-                    alerts_sent["upgrade_time"] = True
-                    msg = (
-                        f"🚨 [UPGRADE TIME] Chain upgrade now!\n"
-                        f"Network: {network}\n"
-                        f"Version: {version}\n"
-                        f"Time: {est_time}\n"
-                        f"Status: Upgrade time has arrived"
-                    )
-                    await broadcast_message(application, msg, network=network)
-
-                # Update alert flags
-                last_upgrades[network]["alerts_sent"] = alerts_sent
-
-            except Exception as e:
-                logger.error(f"Error sending alerts for {network}: {e}", exc_info=True)
-
-    except Exception as e:
-        logger.error(f"Error in check_upgrades: {e}", exc_info=True)
-
-        logger.debug("Sleeping before next check...")
-        await asyncio.sleep(POLL_INTERVAL_SECONDS)
+async def refresh_upgrades():
+    """Fetch upgrades from Polkachu and register new or changed ones"""
+    logger.debug("Checking for upgrades...")
+    parsed = await fetch_upgrades_async()
+    if parsed is None:
+        # Keep the current state; an empty diff would treat every upgrade as delisted
+        return
+    check_for_new_or_changed_upgrades(parsed)
+    prune_last_upgrades(time.time())
+
+    # Log current state
+    logger.info("Found %d upgrades", len(parsed))
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    for upg in parsed:
+        if upg.network not in last_upgrades:
+            continue
+        if upg.epoch is None:
+            logger.debug("%s: unknown upgrade time %r", upg.network, upg.estimated_upgrade_time)
+            continue
+        alerts_sent = last_upgrades[upg.network].alerts_sent
+        logger.debug(
+            "%s: %.1f hours until upgrade. Alerts sent: %s",
+            upg.network, hours_until_upgrade(upg), format(alerts_sent, "03b"),
+        )
+
+async def send_due_alerts(application, now):
+    """Broadcast every alert whose time has come and that hasn't been sent yet"""
+    for network, upg in list(last_upgrades.items()):
+        ready = 0
+        for (_, bit, _, _), due in zip(ALERT_THRESHOLDS, upg.alert_times):
+            if due <= now:
+                ready |= bit
+        to_fire = ready & ~upg.alerts_sent
+        if not to_fire:
+            continue
+
+        # Mark everything due as sent up front so each alert fires exactly once
+        upg = upg._replace(alerts_sent=upg.alerts_sent | to_fire)
+        last_upgrades[network] = upg
+        try:
+            alerts = zip(ALERT_THRESHOLDS, upg.alert_times, upg.alert_messages)
+            for (name, bit, _, grace), due, msg in alerts:
+                if not to_fire & bit:
+                    continue
+                if now - due > grace:
+                    logger.info("Skipping stale %s alert for %s", name, network)
+                    continue
+
+                logger.info("Sending %s alert for %s", name, network)
+                await broadcast_message(application, msg, network=network)
+
+        except Exception as e:
+            logger.error("Error sending alerts for %s: %s", network, e, exc_info=True)
+
+def next_alert_time(now):
+    """Return the earliest pending alert time after now, or None"""
+    pending = [
+        due
+        for upg in last_upgrades.values()
+        for (_, bit, _, _), due in zip(ALERT_THRESHOLDS, upg.alert_times)
+        if not upg.alerts_sent & bit and due > now
+    ]
+    return min(pending, default=None)
+
+async def scheduler_loop(application):
+    """
+    Background task to check for upgrades.
+    Sleeps until the next poll or the next alert time, whichever comes first,
+    and wakes early whenever wakeup_event is set.
+    """
+    next_poll_time = time.time()
+    while True:
+        try:
+            now = time.time()
+            if now >= next_poll_time:
+                # Schedule the next poll first so a failing refresh doesn't retry in a tight loop
+                next_poll_time = now + POLL_INTERVAL_SECONDS
+                await refresh_upgrades()
+
+            await send_due_alerts(application, time.time())
+        except Exception as e:
+            logger.error("Error in scheduler_loop: %s", e, exc_info=True)
+
+        now = time.time()
+        next_wakeup = min(next_poll_time, next_alert_time(now) or next_poll_time)
+        timeout = max(next_wakeup - now, 0)
+
+        logger.debug("Sleeping %.0fs before next check...", timeout)
+        try:
+            await asyncio.wait_for(wakeup_event.wait(), timeout=timeout)
+            wakeup_event.clear()
+        except asyncio.TimeoutError:
+            pass
+
+async def start_scheduler(application):
+    """Start the upgrade scheduler once the application is initialized"""
+    global scheduler_task
+    scheduler_task = asyncio.create_task(scheduler_loop(application))
+
+async def stop_scheduler(application):
+    """Cancel the upgrade scheduler when the application stops"""
+    if scheduler_task:
+        scheduler_task.cancel()
 
 def main():
     """Start the bot"""
     print("Bot has started!")
 
-    # Initialize application
-    application = build_application()
-
-    # Register all command handlers
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("subscribe", subscribe_command))
-    application.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
-    application.add_handler(CommandHandler("list", list_command))
-    application.add_handler(CommandHandler("test", test_alert))
-    application.add_handler(CommandHandler("listupgrades", list_upgrades))
+    # Initialize application, the scheduler runs alongside polling
+    application = build_application(post_init=start_scheduler, post_stop=stop_scheduler)
 
-    # Start upgrade checking in the background
-    application.job_queue.run_repeating(check_upgrades, interval=POLL_INTERVAL_SECONDS)
+    # Register the upgrade command handlers, subscription ones come with the application
+    application.add_handlers([
+        CommandHandler("test", test_alert),
+        CommandHandler("listupgrades", list_upgrades),
+    ])
 
-    # Run the bot (this will block until stopped)
-    application.run_polling()
+    # Run the bot (this will block until stopped). Telegram holds each
+    # getUpdates open for up to GET_UPDATES_TIMEOUT seconds, so idle polling is cheap
+    application.run_polling(poll_interval=0.0, timeout=GET_UPDATES_TIMEOUT)
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,15 @@
+import asyncio
+import functools
+import hashlib
+import sys
+import time
+import orjson
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timezone
 import logging
+from typing import NamedTuple, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -9,29 +18,139 @@ POLKACHU_API = "https://polkachu.com/api/v2/chain_upgrades"
 # Store upgrade info and alert flags here
 last_upgrades = {}
 
+# Upgrades this long past their time are dropped from last_upgrades
+STALE_UPGRADE_SECONDS = 7 * 86400
+
 # Cache of valid networks from Polkachu
 valid_networks = set()
 
+# datetime.fromisoformat only accepts a trailing "Z" from Python 3.11 on
+_FROMISOFORMAT_HANDLES_Z = sys.version_info >= (3, 11)
+
+# Keep-alive session so each poll reuses the TLS connection to Polkachu
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=2,
+    max_retries=Retry(total=3, backoff_factor=0.5),
+))
+
+# Serializes fetches so the session and _cache are only used by one thread at a time
+_fetch_lock = asyncio.Lock()
+
+# Conditional request validators and the parsed result of the last response body
+_cache = {"etag": None, "last_modified": None, "parsed": [], "body_sha": None}
+
+# (network, node_version, block, estimated_upgrade_time) of every upgrade last checked
+_prev_signature = frozenset()
+
+# Bits of Upgrade.alerts_sent
+ALERT_24H = 1
+ALERT_2H = 2
+ALERT_TIME = 4
+
+# (alert name, alerts_sent bit, seconds before the upgrade it fires, seconds late it may still be sent)
+ALERT_THRESHOLDS = (
+    ("24_hours", ALERT_24H, 24 * 3600, 3600),
+    ("2_hours", ALERT_2H, 2 * 3600, 360),
+    ("upgrade_time", ALERT_TIME, 0, 360),
+)
+
+# Alert name -> message template, rendered once per upgrade by alert_messages_for
+ALERT_MESSAGES = {
+    "24_hours": (
+        "⚠️ [24 HOUR ALERT] Chain upgrade approaching!\n"
+        "Network: {network}\n"
+        "Version: {version}\n"
+        "Time: {est_time}\n"
+        "Status: Upgrade in approximately 24 hours"
+    ),
+    "2_hours": (
+        "🚨 [2 HOUR ALERT] Chain upgrade imminent!\n"
+        "Network: {network}\n"
+        "Version: {version}\n"
+        "Time: {est_time}\n"
+        "Status: Upgrade in approximately 2 hours"
+    ),
+    "upgrade_time": (
+        "🚨 [UPGRADE TIME] Chain upgrade now!\n"
+        "Network: {network}\n"
+        "Version: {version}\n"
+        "Time: {est_time}\n"
+        "Status: Upgrade time has arrived"
+    ),
+}
+
+class Upgrade(NamedTuple):
+    """A single upgrade from Polkachu plus its alert state"""
+    network: str
+    chain_name: str
+    node_version: str
+    block: int
+    estimated_upgrade_time: str
+    # estimated_upgrade_time as UTC epoch seconds, None if unparsable
+    epoch: Optional[float]
+    # Due epoch seconds, in ALERT_THRESHOLDS order
+    alert_times: tuple = ()
+    # Rendered ALERT_MESSAGES, in ALERT_THRESHOLDS order
+    alert_messages: tuple = ()
+    # Bitmask of ALERT_24H / ALERT_2H / ALERT_TIME already sent
+    alerts_sent: int = 0
+
+def _store_validators(response):
+    """Remember the response's ETag / Last-Modified for the next conditional request"""
+    _cache["etag"] = response.headers.get("ETag")
+    _cache["last_modified"] = response.headers.get("Last-Modified")
+
 def fetch_upgrades():
     """
     Fetch upcoming chain upgrades from Polkachu.
-    Returns a list (JSON array) of upgrades.
+    Returns the parsed list of upgrades (see parse_upgrades), or None if the fetch failed.
+    Unchanged responses reuse the previous parse instead of re-parsing.
     """
     try:
-        logger.info("Fetching upgrades from Polkachu API")
-        response = requests.get(POLKACHU_API, timeout=10)
+        logger.debug("Fetching upgrades from Polkachu API")
+        headers = {}
+        if _cache["etag"]:
+            headers["If-None-Match"] = _cache["etag"]
+        if _cache["last_modified"]:
+            headers["If-Modified-Since"] = _cache["last_modified"]
+
+        response = _session.get(POLKACHU_API, headers=headers, timeout=10)
+        if response.status_code == 304:
+            logger.debug("Polkachu upgrades not modified")
+            return _cache["parsed"]
         response.raise_for_status()
-        data = response.json()
+
+        body_sha = hashlib.blake2b(response.content, digest_size=16).digest()
+        if body_sha == _cache["body_sha"]:
+            logger.debug("Polkachu upgrades unchanged")
+            _store_validators(response)
+            return _cache["parsed"]
+
+        data = orjson.loads(response.content)
 
         # Update valid networks cache
         global valid_networks
         valid_networks = {upgrade.get("network").lower() for upgrade in data if upgrade.get("network")}
 
-        logger.info(f"Found {len(data)} total upgrades")
-        return data
+        logger.info("Found %d total upgrades", len(data))
+        _cache["parsed"] = parse_upgrades(data)
+        _cache["body_sha"] = body_sha
+        # Only trust the validators once the body parsed, or a bad body would be pinned by 304s
+        _store_validators(response)
+        return _cache["parsed"]
     except Exception as e:
-        logger.error(f"Failed to fetch Polkachu upgrades: {e}")
-        return []
+        logger.error("Failed to fetch Polkachu upgrades: %s", e)
+        return None
+
+async def fetch_upgrades_async():
+    """
+    Run fetch_upgrades in a worker thread so the blocking HTTP request
+    doesn't stall the event loop (and every Telegram handler with it).
+    """
+    async with _fetch_lock:
+        return await asyncio.to_thread(fetch_upgrades)
 
 def is_valid_network(network):
     """Check if a network name is valid"""
@@ -40,76 +159,133 @@ def is_valid_network(network):
 def parse_upgrades(data):
     """
     Parse relevant fields from the Polkachu JSON data.
-    Returns a list of dicts with only the fields we care about.
+    Returns a list of Upgrade tuples with only the fields we care about.
+    """
+    return [
+        Upgrade(
+            upgrade.get("network"),
+            upgrade.get("chain_name"),
+            upgrade.get("node_version"),
+            upgrade.get("block"),
+            upgrade.get("estimated_upgrade_time"),
+            iso_to_epoch(upgrade.get("estimated_upgrade_time")),
+        )
+        for upgrade in data
+    ]
+
+def alert_times_for(epoch):
     """
-    upgrades = []
-    for upgrade in data:
-        logger.debug(f"Parsing upgrade for network: {upgrade.get('network')}")
-        upgrades.append({
-            "network": upgrade.get("network"),
-            "chain_name": upgrade.get("chain_name"),
-            "node_version": upgrade.get("node_version"),
-            "block": upgrade.get("block"),
-            "estimated_upgrade_time": upgrade.get("estimated_upgrade_time"),
-        })
-    return upgrades
-
-def filter_upgrades(upgrades):
-    """Return all valid upgrades."""
-    return upgrades
+    Precompute the exact epoch second at which each alert becomes due.
+    Returns an empty tuple if the upgrade time is unknown.
+    """
+    if epoch is None:
+        return ()
+    return tuple(epoch - lead for _, _, lead, _ in ALERT_THRESHOLDS)
+
+def alert_messages_for(upgrade):
+    """Render every alert message for an upgrade once, ready to broadcast"""
+    return tuple(
+        ALERT_MESSAGES[name].format(
+            network=upgrade.network,
+            version=upgrade.node_version,
+            est_time=upgrade.estimated_upgrade_time,
+        )
+        for name, _, _, _ in ALERT_THRESHOLDS
+    )
 
 def check_for_new_or_changed_upgrades(relevant_upgrades):
     """
     Compare relevant_upgrades with last_upgrades (cache).
+    New or changed upgrades are stored with cleared alert flags and fresh alert times,
+    and networks Polkachu no longer lists are dropped so their alerts stop.
+    Only upgrades that differ from the previous call are looked at.
     Returns a list of upgrades that are newly added or changed.
     """
+    global _prev_signature
+    keys = [
+        (upg.network, upg.node_version, upg.block, upg.estimated_upgrade_time)
+        for upg in relevant_upgrades
+    ]
+    signature = frozenset(keys)
+    if signature == _prev_signature:
+        return []
+    changed = signature - _prev_signature
+    listed = {upg.network for upg in relevant_upgrades}
+    for net in {key[0] for key in _prev_signature - signature} - listed:
+        if last_upgrades.pop(net, None) is not None:
+            logger.info("Upgrade for %s is no longer listed, dropping it", net)
+    _prev_signature = signature
+
     new_or_changed = []
-    for upg in relevant_upgrades:
-        net = upg["network"]
-        version = upg["node_version"]
-        block = upg["block"]
-
-        if net not in last_upgrades:
-            logger.info(f"New upgrade found for {net}")
-            upg["alerts_sent"] = {
-                "2_days_before": False,
-                "1_day_before": False,
-                "2_hours_before": False,
-                "upgrade_time": False
-            }
-            last_upgrades[net] = upg
-            new_or_changed.append(upg)
+    for key, upg in zip(keys, relevant_upgrades):
+        if key not in changed:
+            continue
+        net = upg.network
+
+        old_upg = last_upgrades.get(net)
+        if old_upg is not None and old_upg.node_version == upg.node_version and old_upg.block == upg.block:
+            # Same upgrade, but the estimate drifts with block times
+            if old_upg.estimated_upgrade_time != upg.estimated_upgrade_time:
+                last_upgrades[net] = old_upg._replace(
+                    estimated_upgrade_time=upg.estimated_upgrade_time,
+                    epoch=upg.epoch,
+                    alert_times=alert_times_for(upg.epoch),
+                    alert_messages=alert_messages_for(upg),
+                )
+            continue
+
+        if old_upg is not None:
+            logger.info("Changed upgrade detected for %s", net)
         else:
-            old_upg = last_upgrades[net]
-            if (old_upg["node_version"] != version) or (old_upg["block"] != block):
-                logger.info(f"Changed upgrade detected for {net}")
-                alerts_sent = old_upg.get("alerts_sent", {
-                    "2_days_before": False,
-                    "1_day_before": False,
-                    "2_hours_before": False,
-                    "upgrade_time": False
-                })
-                upg["alerts_sent"] = alerts_sent
-                last_upgrades[net] = upg
-                new_or_changed.append(upg)
+            logger.info("New upgrade found for %s", net)
+
+        upg = upg._replace(
+            alert_times=alert_times_for(upg.epoch),
+            alert_messages=alert_messages_for(upg),
+            alerts_sent=0,
+        )
+        last_upgrades[net] = upg
+        new_or_changed.append(upg)
 
     return new_or_changed
 
+def prune_last_upgrades(now):
+    """Drop upgrades that happened more than STALE_UPGRADE_SECONDS before now"""
+    cutoff = now - STALE_UPGRADE_SECONDS
+    stale = [
+        net for net, upg in last_upgrades.items()
+        if upg.epoch is not None and upg.epoch < cutoff
+    ]
+    for net in stale:
+        logger.info("Dropping stale upgrade for %s", net)
+        del last_upgrades[net]
+
 def parse_iso_time(iso_string):
-    """Parse ISO 8601 time string into datetime object."""
+    """Parse ISO 8601 time string into a UTC-aware datetime object."""
     try:
-        iso_string = iso_string.replace('Z', '')
+        if not _FROMISOFORMAT_HANDLES_Z and iso_string.endswith('Z'):
+            iso_string = iso_string[:-1]
         dt = datetime.fromisoformat(iso_string)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
         return dt
-    except ValueError as e:
-        logger.error(f"Error parsing time {iso_string}: {e}")
+    except (AttributeError, TypeError, ValueError) as e:
+        logger.error("Error parsing time %s: %s", iso_string, e)
         return None
 
-def hours_until_upgrade(iso_string):
-    """Return hours until upgrade time."""
+@functools.lru_cache(maxsize=512)
+def iso_to_epoch(iso_string):
+    """
+    Return the UTC epoch seconds of an ISO 8601 time, or None if unparsable.
+    Memoized, since the same times come back on every poll.
+    """
     upgrade_dt = parse_iso_time(iso_string)
     if not upgrade_dt:
+        return None
+    return upgrade_dt.timestamp()
+
+def hours_until_upgrade(upgrade):
+    """Return hours until an Upgrade's estimated time, or -1 if it's unknown."""
+    if upgrade.epoch is None:
         return -1
-    now = datetime.utcnow()
-    delta = upgrade_dt - now
-    return delta.total_seconds() / 3600.0
+    return (upgrade.epoch - time.time()) / 3600.0
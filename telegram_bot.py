@@ -1,7 +1,13 @@
 import os
-import json
 import logging
+import re
+import sqlite3
+import sys
+import asyncio
+import orjson
+from collections import defaultdict
 from telegram import Update
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -11,173 +17,404 @@ from telegram.ext import (
 
 # Configure logging
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
 # Dictionary: chat_id -> set of networks
 chat_subscriptions = {}  # e.g., { 12345678: {"orai", "cosmos"} }
+SUBSCRIPTIONS_DB = "subs.db"
+# Legacy JSON store, imported into the database once if the database is empty
 SUBSCRIPTIONS_FILE = "subscriptions.json"
+# SUBSCRIPTIONS_FILE is renamed to this once imported so it is never imported again
+IMPORTED_SUBSCRIPTIONS_FILE = SUBSCRIPTIONS_FILE + ".imported"
+
+# Lazily opened connection to SUBSCRIPTIONS_DB
+_db = None
+# Serializes writes, which run in worker threads off the event loop
+_db_lock = asyncio.Lock()
+
+# Queued changes not yet written: (chat_id, network) -> True to add, False to remove
+_pending = {}
+# Set when _pending has changes; the flusher writes them at most every FLUSH_DELAY_SECONDS
+_dirty = asyncio.Event()
+FLUSH_DELAY_SECONDS = 2
+_flusher_task = None
+
+# Reverse index: network -> set of chat_ids, kept in sync with chat_subscriptions
+network_subscribers = defaultdict(set)  # e.g., { "cosmos": {12345678} }
+
+# chat_id -> rendered /list reply, dropped whenever that chat's subscriptions change
+_list_cache = {}
+
+# Telegram allows ~30 messages per second, keep concurrent sends below that
+MAX_CONCURRENT_SENDS = 25
+_send_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+# Broadcasts go out in batches of at most this many chats per second
+BROADCAST_BATCH_SIZE = 30
+
+# Attempts per message before giving up on flood waits and network errors
+SEND_ATTEMPTS = 3
+
+# Splits /subscribe and /unsubscribe arguments on commas and whitespace
+_NETWORK_SEPARATORS = re.compile(r'[\s,]+')
+
+# Set whenever subscriptions change so the upgrade scheduler re-evaluates early
+wakeup_event = asyncio.Event()
 
 def get_chat_subscriptions(chat_id: int) -> set:
     """Get subscriptions for a specific chat"""
-    global chat_subscriptions
-    # Ensure we have latest data
-    load_subscriptions()
+    # chat_subscriptions is loaded at startup and kept current by every writer
     return chat_subscriptions.get(chat_id, set())
 
+def _get_db() -> sqlite3.Connection:
+    """Open the subscriptions database, creating the schema on first use"""
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(SUBSCRIPTIONS_DB, isolation_level=None, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS sub("
+            "chat_id INTEGER, network TEXT, PRIMARY KEY(chat_id, network))"
+        )
+        _db.execute("CREATE INDEX IF NOT EXISTS idx_net ON sub(network)")
+    return _db
+
+def _import_legacy_subscriptions(db: sqlite3.Connection):
+    """Copy subscriptions from the old JSON file into an empty database"""
+    if not os.path.exists(SUBSCRIPTIONS_FILE):
+        return
+    # A populated database already supersedes the file
+    if not db.execute("SELECT 1 FROM sub LIMIT 1").fetchone():
+        logger.info("Importing subscriptions from %s", SUBSCRIPTIONS_FILE)
+        with open(SUBSCRIPTIONS_FILE, 'rb') as f:
+            data = orjson.loads(f.read())
+        if not _write_pending({(int(k), net): True for k, networks in data.items() for net in networks}):
+            # Leave the file in place so the import is retried on the next start
+            return
+
+    os.replace(SUBSCRIPTIONS_FILE, IMPORTED_SUBSCRIPTIONS_FILE)
+    logger.info("Renamed %s to %s", SUBSCRIPTIONS_FILE, IMPORTED_SUBSCRIPTIONS_FILE)
+
 def load_subscriptions():
-    """Load subscriptions from file"""
-    global chat_subscriptions
+    """Load subscriptions from the database"""
     try:
         logger.info("===== LOADING SUBSCRIPTIONS =====")
-        if os.path.exists(SUBSCRIPTIONS_FILE):
-            with open(SUBSCRIPTIONS_FILE, 'r') as f:
-                data = json.load(f)
-                logger.info(f"Raw data from file: {data}")
-                chat_subscriptions = {
-                    int(k): set(v) for k, v in data.items()
-                }
-            logger.info(f"Converted subscriptions: {chat_subscriptions}")
-        else:
-            logger.warning("No subscriptions file found!")
+        db = _get_db()
+        _import_legacy_subscriptions(db)
+
+        loaded = {}
+        loaded_index = defaultdict(set)
+        for chat_id, net in db.execute("SELECT chat_id, network FROM sub"):
+            # Intern so every chat's set shares one string object per network
+            net = sys.intern(net)
+            loaded.setdefault(chat_id, set()).add(net)
+            loaded_index[net].add(chat_id)
+        # Update in place so modules that imported these names see the new data
+        chat_subscriptions.clear()
+        chat_subscriptions.update(loaded)
+        network_subscribers.clear()
+        network_subscribers.update(loaded_index)
+        _list_cache.clear()
+        logger.info("Loaded subscriptions for %d chats", len(chat_subscriptions))
+        logger.debug("Loaded subscriptions: %s", chat_subscriptions)
     except Exception as e:
-        logger.error(f"Error loading subscriptions: {e}", exc_info=True)
+        logger.error("Error loading subscriptions: %s", e, exc_info=True)
 
-def save_subscriptions():
-    """Save subscriptions to file"""
+def _write_pending(batch) -> bool:
+    """Apply a batch of queued changes in a single transaction"""
+    db = _get_db()
     try:
-        # Convert sets to lists for JSON serialization
-        data = {
-            str(k): list(v) for k, v in chat_subscriptions.items()
-        }
-        with open(SUBSCRIPTIONS_FILE, 'w') as f:
-            json.dump(data, f)
-        logger.info("Saved subscriptions to file")
-        logger.debug(f"Saved data: {data}")
+        db.execute("BEGIN")
+        db.executemany(
+            "INSERT OR IGNORE INTO sub(chat_id, network) VALUES (?, ?)",
+            [key for key, add in batch.items() if add],
+        )
+        db.executemany(
+            "DELETE FROM sub WHERE chat_id = ? AND network = ?",
+            [key for key, add in batch.items() if not add],
+        )
+        db.execute("COMMIT")
+        return True
     except Exception as e:
-        logger.error(f"Error saving subscriptions: {e}")
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        logger.error("Error saving subscriptions: %s", e, exc_info=True)
+        return False
+
+async def flush_subscriptions():
+    """Write all queued subscription changes to the database"""
+    global _pending
+    async with _db_lock:
+        if not _pending:
+            return
+        batch, _pending = _pending, {}
+        if await asyncio.to_thread(_write_pending, batch):
+            logger.info("Saved %d subscription changes", len(batch))
+            return
+
+    # Keep the failed changes for the next flush unless newer ones replaced them
+    for key, add in batch.items():
+        _pending.setdefault(key, add)
+    _dirty.set()
+
+async def _flusher():
+    """Background task that coalesces bursts of subscription changes into one write"""
+    while True:
+        await _dirty.wait()
+        await asyncio.sleep(FLUSH_DELAY_SECONDS)
+        _dirty.clear()
+        # Shielded so cancelling the flusher never abandons a write in progress
+        await asyncio.shield(flush_subscriptions())
+
+def add_subscriptions(chat_id: int, networks):
+    """Queue new subscriptions for a chat to be persisted"""
+    for net in networks:
+        _pending[(chat_id, net)] = True
+    _dirty.set()
+
+def remove_subscriptions(chat_id: int, networks):
+    """Queue subscriptions of a chat to be deleted"""
+    for net in networks:
+        _pending[(chat_id, net)] = False
+    _dirty.set()
+
+def _index_subscriptions(chat_id: int, networks):
+    """Add a chat to network_subscribers for each network"""
+    _list_cache.pop(chat_id, None)  # its /list reply is now stale
+    for net in networks:
+        network_subscribers[net].add(chat_id)
+
+def _unindex_subscriptions(chat_id: int, networks):
+    """Remove a chat from network_subscribers, dropping networks left with no subscribers"""
+    _list_cache.pop(chat_id, None)  # its /list reply is now stale
+    for net in networks:
+        subscribers = network_subscribers.get(net)
+        if subscribers is not None:
+            subscribers.discard(chat_id)
+            if not subscribers:
+                del network_subscribers[net]
+
+def _parse_networks(args) -> set:
+    """Return the interned, lowercased network names in command args, split by commas or spaces"""
+    return {
+        sys.intern(net.lower())
+        for net in _NETWORK_SEPARATORS.split(' '.join(args))
+        if net
+    }
+
+_WELCOME = (
+    "Welcome to the Cosmos Upgrade Tracker Bot!\n\n"
+    "Use /subscribe <network> to receive alerts for specific networks (e.g. /subscribe cosmos osmosis).\n"
+    "Use /unsubscribe <network> to remove a subscription.\n"
+    "Use /list to see which networks you've subscribed to.\n"
+    "Use /listupgrades to see upcoming upgrades for your subscribed networks."
+)
+_SUBSCRIBE_USAGE = "Usage: /subscribe <network1> <network2> ..."
+_UNSUBSCRIBE_USAGE = "Usage: /unsubscribe <network1> <network2> ..."
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send welcome message and help text"""
-    await update.message.reply_text(
-        "Welcome to the Cosmos Upgrade Tracker Bot!\n\n"
-        "Use /subscribe <network> to receive alerts for specific networks (e.g. /subscribe cosmos osmosis).\n"
-        "Use /unsubscribe <network> to remove a subscription.\n"
-        "Use /list to see which networks you've subscribed to.\n"
-        "Use /listupgrades to see upcoming upgrades for your subscribed networks."
-    )
+    await update.message.reply_text(_WELCOME)
 
 async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Subscribe to updates for specific networks"""
     chat_id = update.effective_chat.id
-    logger.info(f"Subscribe command from chat_id: {chat_id}")
+    logger.info("Subscribe command from chat_id: %s", chat_id)
 
     if not context.args:
-        await update.message.reply_text("Usage: /subscribe <network1> <network2> ...")
+        await update.message.reply_text(_SUBSCRIBE_USAGE)
         return
 
-    if chat_id not in chat_subscriptions:
-        chat_subscriptions[chat_id] = set()
-
-    added_networks = []
-    # Join all args and split by commas or spaces
-    networks = ' '.join(context.args).replace(',', ' ').split()
-
-    for net in networks:
-        net_lower = net.strip().lower()
-        if net_lower and net_lower not in chat_subscriptions[chat_id]:  # Check if not empty
-            chat_subscriptions[chat_id].add(net_lower)
-            added_networks.append(net_lower)
+    networks = _parse_networks(context.args)
+    existing = chat_subscriptions.setdefault(chat_id, set())
+    added_networks = networks - existing
 
     if added_networks:
-        save_subscriptions()  # Save after successful subscription
-        await update.message.reply_text(f"Successfully subscribed to: {', '.join(added_networks)}")
+        existing |= added_networks
+        _index_subscriptions(chat_id, added_networks)
+        add_subscriptions(chat_id, added_networks)
+        wakeup_event.set()
+        await update.message.reply_text(f"Successfully subscribed to: {', '.join(sorted(added_networks))}")
     else:
         await update.message.reply_text("You were already subscribed to all of those networks.")
 
 async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Unsubscribe from updates for specific networks"""
     chat_id = update.effective_chat.id
-    logger.info(f"Unsubscribe command from chat_id: {chat_id}")
-
-    if chat_id not in chat_subscriptions:
-        chat_subscriptions[chat_id] = set()
+    logger.info("Unsubscribe command from chat_id: %s", chat_id)
 
     if not context.args:
-        await update.message.reply_text("Usage: /unsubscribe <network1> <network2> ...")
+        await update.message.reply_text(_UNSUBSCRIBE_USAGE)
         return
 
-    removed_networks = []
-    networks = ' '.join(context.args).replace(',', ' ').split()
-
-    for net in networks:
-        net_lower = net.strip().lower()
-        if net_lower in chat_subscriptions[chat_id]:
-            chat_subscriptions[chat_id].remove(net_lower)
-            removed_networks.append(net_lower)
+    networks = _parse_networks(context.args)
+    existing = chat_subscriptions.setdefault(chat_id, set())
+    removed_networks = networks & existing
 
     if removed_networks:
-        save_subscriptions()  # Save after successful unsubscription
-        await update.message.reply_text(f"Successfully unsubscribed from: {', '.join(removed_networks)}")
+        existing -= removed_networks
+        _unindex_subscriptions(chat_id, removed_networks)
+        remove_subscriptions(chat_id, removed_networks)
+        wakeup_event.set()
+        await update.message.reply_text(f"Successfully unsubscribed from: {', '.join(sorted(removed_networks))}")
     else:
         await update.message.reply_text("You weren't subscribed to any of those networks.")
 
 async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show current subscriptions"""
     chat_id = update.effective_chat.id
-    logger.info("================ LIST COMMAND DEBUG ================")
-    logger.info(f"List command from chat_id: {chat_id}")
-    logger.info(f"chat_subscriptions object id: {id(chat_subscriptions)}")
-    logger.info(f"Full chat_subscriptions dict: {chat_subscriptions}")
-    logger.info(f"Type of chat_id: {type(chat_id)}")
-    logger.info(f"Keys in chat_subscriptions: {chat_subscriptions.keys()}")
-    logger.info(f"chat_id exists in dict: {chat_id in chat_subscriptions}")
-
-    subs = chat_subscriptions.get(chat_id, set())
-    if subs:
-        subs_str = ", ".join(sorted(subs))
-        await update.message.reply_text(f"You are subscribed to: {subs_str}")
-    else:
-        await update.message.reply_text("You are not subscribed to any networks.")
+    logger.info("List command from chat_id: %s", chat_id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("================ LIST COMMAND DEBUG ================")
+        logger.debug("chat_subscriptions object id: %s", id(chat_subscriptions))
+        logger.debug("Full chat_subscriptions dict: %s", chat_subscriptions)
+        logger.debug("chat_id exists in dict: %s", chat_id in chat_subscriptions)
 
-def build_application() -> Application:
+    reply = _list_cache.get(chat_id)
+    if reply is None:
+        subs = chat_subscriptions.get(chat_id, set())
+        if subs:
+            reply = f"You are subscribed to: {', '.join(sorted(subs))}"
+        else:
+            reply = "You are not subscribed to any networks."
+        _list_cache[chat_id] = reply
+    await update.message.reply_text(reply)
+
+# Subscription command handlers, built once at import and registered by build_application
+_HANDLERS = [
+    CommandHandler(name, callback)
+    for name, callback in (
+        ("start", start_command),
+        ("subscribe", subscribe_command),
+        ("unsubscribe", unsubscribe_command),
+        ("list", list_command),
+    )
+]
+
+def build_application(post_init=None, post_stop=None) -> Application:
     """Build and configure the bot application"""
-    global chat_subscriptions
     # Load existing subscriptions
     load_subscriptions()
-    logger.info(f"Loaded subscriptions at startup: {chat_subscriptions}")
 
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     if not token:
         raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set!")
 
-    logger.debug(f"Building application with token length: {len(token)}")
+    logger.debug("Building application with token length: %d", len(token))
 
-    application = ApplicationBuilder().token(token).build()
+    async def start_flusher(application: Application):
+        global _flusher_task
+        _flusher_task = asyncio.create_task(_flusher())
+        if post_init:
+            await post_init(application)
 
-    # Verify subscriptions loaded
-    logger.info(f"Verifying subscriptions after build: {chat_subscriptions}")
+    async def stop_flusher(application: Application):
+        # Write whatever is still queued before the process exits
+        if _flusher_task:
+            _flusher_task.cancel()
+            try:
+                await _flusher_task
+            except asyncio.CancelledError:
+                pass
+        # Waits on _db_lock for any shielded write still running
+        await flush_subscriptions()
+
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .post_init(start_flusher)
+        .post_stop(post_stop)
+        .post_shutdown(stop_flusher)
+        .build()
+    )
+
+    application.add_handlers(_HANDLERS)
 
     return application
+def _prune_chat(chat_id: int):
+    """Drop all subscriptions of a chat the bot can no longer message"""
+    networks = chat_subscriptions.pop(chat_id, set())
+    _unindex_subscriptions(chat_id, networks)
+    remove_subscriptions(chat_id, networks)
+
+def _migrate_chat(old_chat_id: int, new_chat_id: int):
+    """Move subscriptions of a group that was upgraded to a supergroup"""
+    networks = chat_subscriptions.pop(old_chat_id, set())
+    chat_subscriptions.setdefault(new_chat_id, set()).update(networks)
+    _unindex_subscriptions(old_chat_id, networks)
+    _index_subscriptions(new_chat_id, networks)
+    remove_subscriptions(old_chat_id, networks)
+    add_subscriptions(new_chat_id, networks)
+
+async def _send_one(application: Application, chat_id: int, message: str) -> bool:
+    """Send a message to one chat, returning True if it was delivered"""
+    async with _send_semaphore:
+        for attempt in range(1, SEND_ATTEMPTS + 1):
+            try:
+                await application.bot.send_message(chat_id=chat_id, text=message)
+            except Forbidden as e:
+                logger.warning("Removing subscriptions for chat_id %s, bot can't post there: %s", chat_id, e)
+                _prune_chat(chat_id)
+                return False
+            except ChatMigrated as e:
+                logger.info("Chat %s migrated to %s, moving subscriptions", chat_id, e.new_chat_id)
+                _migrate_chat(chat_id, e.new_chat_id)
+                chat_id = e.new_chat_id
+                continue
+            except RetryAfter as e:
+                error, delay = e, e.retry_after + 0.5
+            except BadRequest:
+                # Also a NetworkError, but retrying won't help
+                raise
+            except NetworkError as e:
+                error, delay = e, 2 ** attempt
+            else:
+                logger.debug("Successfully sent message to chat_id: %s", chat_id)
+                return True
+
+            logger.warning("Send to chat_id %s failed (attempt %d/%d): %s", chat_id, attempt, SEND_ATTEMPTS, error)
+            if attempt < SEND_ATTEMPTS:
+                await asyncio.sleep(delay)
+
+    logger.error("Giving up sending to chat_id %s after %d attempts", chat_id, SEND_ATTEMPTS)
+    return False
+
 async def broadcast_message(application: Application, message: str, network: str = None):
     """Send message to subscribed chats"""
     if network:
         network = network.lower()
 
-    logger.info(f"Broadcasting message for network: {network}")
-    logger.info(f"Message content: {message}")
-    logger.info(f"Current subscriptions: {chat_subscriptions}")
+    logger.info("Broadcasting message for network: %s", network)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Message content: %s", message)
+        logger.debug("Current subscriptions: %s", chat_subscriptions)
+
+    if network:
+        targets = list(network_subscribers.get(network, ()))
+    else:
+        targets = list(chat_subscriptions)
+
+    loop = asyncio.get_running_loop()
+    results = []
+    for start in range(0, len(targets), BROADCAST_BATCH_SIZE):
+        batch_started = loop.time()
+        batch = targets[start:start + BROADCAST_BATCH_SIZE]
+        results += await asyncio.gather(
+            *(_send_one(application, chat_id, message) for chat_id in batch),
+            return_exceptions=True,
+        )
+        # Pace batches to stay under Telegram's global rate limit
+        if start + BROADCAST_BATCH_SIZE < len(targets):
+            await asyncio.sleep(max(0.0, 1.0 - (loop.time() - batch_started)))
 
     sent_count = 0
-    for chat_id, networks in chat_subscriptions.items():
-        if network is None or network in networks:
-            try:
-                await application.bot.send_message(chat_id=chat_id, text=message)
-                logger.info(f"Successfully sent message to chat_id: {chat_id}")
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Failed to send message to {chat_id}: {e}", exc_info=True)
+    for chat_id, result in zip(targets, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to send message to %s: %s", chat_id, result, exc_info=result)
+        elif result:
+            sent_count += 1
 
-    logger.info(f"Broadcast complete. Sent to {sent_count} chats")
+    logger.info("Broadcast complete. Sent to %d chats", sent_count)